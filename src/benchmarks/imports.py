@@ -0,0 +1,72 @@
+"""Import time and memory benchmark for the API and worker entry points.
+
+Each module is imported in a fresh interpreter, so results are not skewed by
+modules already loaded. RabbitMQ has to be running, since the producer
+connects on import.
+
+Run from src/ with: python -m benchmarks.imports
+"""
+
+import json
+import subprocess
+import sys
+
+# modules that only the workers should load, and only on first use
+HEAVY_MODULES = ("torch", "torchvision", "super_image")
+
+# entry points to benchmark
+ENTRY_POINTS = ("main", "workers")
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure(module: str) -> dict:
+    """Import a module in a new interpreter and measure the cost
+
+    Args:
+        module (str): name of module to import
+
+    Returns:
+        dict: import time in seconds, peak RSS in MB and heavy modules loaded
+    """
+
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def main() -> None:
+    failed = False
+
+    for module in ENTRY_POINTS:
+        result = measure(module)
+        print(
+            f"{module:<10} {result['seconds']:7.3f} s {result['rss_mb']:9.1f} MB"
+            f"  heavy modules: {', '.join(result['heavy']) or 'none'}"
+        )
+
+        if result["heavy"]:
+            failed = True
+
+    # neither entry point should pull in the ML stack at import time
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Latency, throughput and quality benchmark for the inference backends.
+
+Every configuration upscales the same image, and its output is compared to
+the eager fp32 output with PSNR. Latency is measured with a single caller,
+throughput with as many concurrent callers as a worker process has threads.
+
+Exits with an error if any backend fails or falls below its quality
+threshold. Backends whose optional packages are missing are skipped. The
+thresholds are meant for natural images, e.g. a photo uploaded to the API,
+not for noise or synthetic patterns.
+
+Run from src/ with: python -m benchmarks.inference image [--threads N]
+    [--callers N], defaults match the worker layout, see inference.py
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import math
+import statistics
+import sys
+import time
+
+from PIL import Image
+
+from inference import (
+    BackendUnavailable,
+    Engine,
+    THREADS,
+    WORKER_THREADS,
+    load_engine,
+)
+
+# (backend, quantize) pairs to benchmark, the first one is the reference
+CONFIGURATIONS = (
+    ("eager", False),
+    ("torchscript", False),
+    ("onnx", False),
+    ("onnx", True),
+)
+
+# minimum PSNR against the reference on natural images, in dB
+MIN_PSNR = 40.0
+MIN_PSNR_QUANTIZED = 30.0
+
+
+def psnr(reference, output) -> float:
+    """Peak signal to noise ratio between two images in the [0, 1] range
+
+    Args:
+        reference (Tensor): reference image
+        output (Tensor): image to compare
+
+    Returns:
+        float: PSNR in dB (infinite if the images are identical)
+    """
+
+    mse = ((reference.clamp(0, 1) - output.clamp(0, 1)) ** 2).mean().item()
+    if mse == 0:
+        return math.inf
+
+    return 10 * math.log10(1 / mse)
+
+
+def throughput(engine: Engine, inputs, callers: int, runs: int) -> float:
+    """Measure throughput with several callers sharing one engine, like the
+    threads of a worker process do
+
+    Args:
+        engine (Engine): engine to run
+        inputs (Tensor): input image
+        callers (int): concurrent callers
+        runs (int): runs per caller
+
+    Returns:
+        float: images per second
+    """
+
+    def call(_) -> None:
+        for _ in range(runs):
+            engine(inputs)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(callers) as executor:
+        list(executor.map(call, range(callers)))
+
+    return callers * runs / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", help="natural image to upscale")
+    parser.add_argument("--factor", type=int, default=2, help="upscale factor")
+    parser.add_argument(
+        "--threads", type=int, default=THREADS, help="intra-op threads"
+    )
+    parser.add_argument(
+        "--callers",
+        type=int,
+        default=WORKER_THREADS,
+        help="concurrent callers, the threads of one worker process",
+    )
+    parser.add_argument("--runs", type=int, default=10, help="timed runs")
+    args = parser.parse_args()
+
+    from super_image import ImageLoader
+
+    with Image.open(args.image) as image:
+        inputs = ImageLoader.load_image(image.convert("RGB"))
+
+    reference = None
+    failed = False
+
+    print(
+        f"input {tuple(inputs.shape)}, x{args.factor}, {args.threads} thread(s),"
+        f" {args.callers} caller(s)"
+    )
+
+    for backend, quantize in CONFIGURATIONS:
+        name = backend + (" int8" if quantize else "")
+
+        try:
+            start = time.perf_counter()
+            engine = load_engine(args.factor, backend, quantize, args.threads)
+            output = engine(inputs)  # warmup, also used for the quality check
+            setup = time.perf_counter() - start
+
+            timings = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                engine(inputs)
+                timings.append(time.perf_counter() - start)
+
+            rate = throughput(engine, inputs, args.callers, args.runs)
+
+        except BackendUnavailable as e:
+            print(f"{name:<16} skipped: {e}")
+            continue
+        except Exception as e:
+            print(f"{name:<16} FAILED: {e}")
+
+            # without the reference, no other backend can be checked
+            if reference is None:
+                sys.exit(1)
+
+            failed = True
+            continue
+
+        if reference is None:
+            reference = output
+
+        quality = psnr(reference, output)
+        threshold = MIN_PSNR_QUANTIZED if quantize else MIN_PSNR
+        if quality < threshold:
+            failed = True
+
+        print(
+            f"{name:<16} setup {setup:7.2f} s"
+            f"  latency {statistics.median(timings) * 1000:8.1f} ms (median)"
+            f"  {rate:6.2f} images/s"
+            f"  PSNR {quality:6.2f} dB{'' if quality >= threshold else '  FAILED'}"
+        )
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
 from mongoengine import (
     connect,
+    DateTimeField,
+    DictField,
     Document,
     FloatField,
     IntField,
+    ListField,
+    Q,
     StringField,
 )
 
 db = connect("imageCRUD", serverSelectionTimeoutMS=2000)
 
+# after this long without being refreshed, a lock is considered abandoned
+LOCK_TIMEOUT = timedelta(minutes=10)
+
 
 class Image(Document):
     """MongoDB document holding image info and the path to it"""
@@ -17,3 +26,82 @@ class Image(Document):
     height = IntField()  # height in pixels
     format = StringField(max_length=10)  # image file format
     path = StringField(max_length=128)  # path to image in storage
+    version = IntField(default=0)  # incremented on every accepted change
+    pending = ListField(DictField())  # modifications waiting for a worker
+    locked_at = DateTimeField()  # last time the lock holder refreshed the lock
+    locked_by = StringField(max_length=32)  # token of the lock holder
+
+
+def match_version(version: int) -> Q:
+    """Query matching images at a given version. Images saved before
+    versioning have no version field, which counts as version 0
+
+    Args:
+        version (int): expected version
+
+    Returns:
+        Q: query
+    """
+
+    if version == 0:
+        return Q(version=0) | Q(version__exists=False)
+
+    return Q(version=version)
+
+
+def lock_image(image_id: str) -> str | None:
+    """Take the lock on an image, so only one worker or request changes its
+    file at a time. Locks not refreshed for LOCK_TIMEOUT are taken over
+
+    Args:
+        image_id (str): id of the image
+
+    Returns:
+        str | None: lock token, None if the image is locked or does not exist
+    """
+
+    token = uuid4().hex
+    now = datetime.utcnow()
+
+    image = Image.objects(
+        Q(id=image_id) & (Q(locked_at=None) | Q(locked_at__lt=now - LOCK_TIMEOUT))
+    ).modify(set__locked_at=now, set__locked_by=token, new=True)
+
+    return None if image is None else token
+
+
+def refresh_lock(image_id: str, token: str) -> bool:
+    """Refresh a lock, so it is not considered abandoned
+
+    Args:
+        image_id (str): id of the image
+        token (str): lock token
+
+    Returns:
+        bool: False if the lock was lost or the image deleted
+    """
+
+    return bool(
+        Image.objects(id=image_id, locked_by=token).modify(
+            set__locked_at=datetime.utcnow()
+        )
+    )
+
+
+def unlock_image(image_id: str, token: str, **conditions) -> bool:
+    """Release a lock
+
+    Args:
+        image_id (str): id of the image
+        token (str): lock token
+        conditions: extra conditions the image has to match
+
+    Returns:
+        bool: False if the lock is not held or the conditions did not match
+    """
+
+    return bool(
+        Image.objects(id=image_id, locked_by=token, **conditions).modify(
+            unset__locked_at=True, unset__locked_by=True
+        )
+    )
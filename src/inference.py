@@ -0,0 +1,340 @@
+"""CPU inference engines for the EDSR upscale model.
+
+Backends:
+    eager: plain PyTorch forward pass, used as the quality reference
+    torchscript: traced, frozen and optimized TorchScript module
+    onnx: ONNX Runtime CPU session (needs the onnx extra)
+
+Dynamic int8 quantization only applies to the onnx backend, since PyTorch's
+dynamic quantization does not cover the convolutions EDSR is made of.
+
+Workers pick their engine through environment variables:
+    IMAGECRUD_BACKEND: one of BACKENDS (default torchscript)
+    IMAGECRUD_QUANTIZE: set to 1 to quantize the model to int8
+    IMAGECRUD_WORKER_PROCESSES, IMAGECRUD_WORKER_THREADS: the --processes and
+        --threads the workers run with (default to dramatiq's own defaults,
+        one process per CPU core and 8 threads per process)
+    IMAGECRUD_THREADS: intra-op threads per inference (default: the CPU
+        cores left to each of the processes x threads concurrent inferences,
+        at least 1)
+    IMAGECRUD_MODEL_CACHE: directory for exported models
+        (default ~/.cache/imagecrud)
+
+Like workers.py, nothing from the ML stack is imported at module level.
+"""
+
+from collections.abc import Callable
+from functools import lru_cache
+from typing import TYPE_CHECKING, TypeAlias
+import hashlib
+import os
+import tempfile
+import threading
+
+if TYPE_CHECKING:
+    from torch import Tensor
+
+# maps a (1, 3, H, W) float tensor to the upscaled tensor
+Engine: TypeAlias = Callable[["Tensor"], "Tensor"]
+
+BACKENDS = ("eager", "torchscript", "onnx")
+
+BACKEND = os.environ.get("IMAGECRUD_BACKEND", "torchscript")
+QUANTIZE = os.environ.get("IMAGECRUD_QUANTIZE", "0") == "1"
+WORKER_PROCESSES = int(os.environ.get("IMAGECRUD_WORKER_PROCESSES", os.cpu_count()))
+WORKER_THREADS = int(os.environ.get("IMAGECRUD_WORKER_THREADS", "8"))
+THREADS = int(
+    os.environ.get(
+        "IMAGECRUD_THREADS",
+        max(1, os.cpu_count() // (WORKER_PROCESSES * WORKER_THREADS)),
+    )
+)
+MODEL_CACHE = os.environ.get(
+    "IMAGECRUD_MODEL_CACHE", os.path.expanduser("~/.cache/imagecrud")
+)
+
+# worker threads share engines, only one of them may build an engine at a time
+ENGINE_LOCK = threading.Lock()
+
+# shape used for tracing and exporting, height and width stay dynamic
+SAMPLE_SHAPE = (1, 3, 64, 64)
+
+
+class BackendUnavailable(RuntimeError):
+    """Raised when the packages a backend needs are not installed"""
+
+
+def set_threads(threads: int) -> None:
+    """Set the number of threads PyTorch uses in this process
+
+    Args:
+        threads (int): intra-op threads
+    """
+
+    import torch
+
+    torch.set_num_threads(threads)
+
+    # inter-op threads can only be set before any parallel work has started
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def load_model(factor: int):
+    """Load the pretrained EDSR model, once per process
+
+    Args:
+        factor (int): upscale factor
+
+    Returns:
+        EdsrModel: pretrained model, in eval mode
+    """
+
+    from super_image import EdsrModel
+
+    model = EdsrModel.from_pretrained("eugenesiow/edsr-base", scale=factor)
+    model.eval()
+
+    return model
+
+
+def eager_engine(factor: int) -> Engine:
+    """Build an engine running the model in eager mode
+
+    Args:
+        factor (int): upscale factor
+
+    Returns:
+        Engine: engine mapping an input tensor to an output tensor
+    """
+
+    import torch
+
+    model = load_model(factor)
+
+    def run(inputs):
+        with torch.inference_mode():
+            return model(inputs)
+
+    return run
+
+
+def torchscript_engine(factor: int) -> Engine:
+    """Build an engine running a traced and frozen TorchScript module
+
+    Args:
+        factor (int): upscale factor
+
+    Returns:
+        Engine: engine mapping an input tensor to an output tensor
+    """
+
+    import torch
+
+    model = load_model(factor)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.rand(SAMPLE_SHAPE))
+    traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    def run(inputs):
+        with torch.inference_mode():
+            return traced(inputs)
+
+    return run
+
+
+def weights_hash(model) -> str:
+    """Short hash of a model's weights, used to tell exported models apart
+
+    Args:
+        model (Module): PyTorch model
+
+    Returns:
+        str: hex digest
+    """
+
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+def write_atomic(path: str, write: Callable[[str], None]) -> None:
+    """Write a file through a unique temp file in the same directory, then
+    rename it over the target. Processes exporting at the same time each
+    write their own file, and the last rename wins.
+
+    Args:
+        path (str): path of the file to write
+        write (Callable[[str], None]): function writing to the given path
+    """
+
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    os.close(fd)
+
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def export_onnx(factor: int, quantize: bool) -> str:
+    """Export the model to ONNX, quantizing it if needed
+
+    Exported files are kept in MODEL_CACHE, so they are shared between worker
+    processes and restarts. Their names include the torch version and a hash
+    of the weights, so a new model or torch release gets a new export.
+
+    Args:
+        factor (int): upscale factor
+        quantize (bool): quantize weights to int8
+
+    Returns:
+        str: path to the ONNX file
+    """
+
+    import torch
+
+    model = load_model(factor)
+
+    os.makedirs(MODEL_CACHE, mode=0o700, exist_ok=True)
+    name = f"edsr-x{factor}-torch{torch.__version__}-{weights_hash(model)}"
+    path = os.path.join(MODEL_CACHE, name + ".onnx")
+    quantized_path = os.path.join(MODEL_CACHE, name + "-int8.onnx")
+
+    if not os.path.isfile(path):
+
+        def export(temp_path: str) -> None:
+            with torch.no_grad():
+                torch.onnx.export(
+                    model,
+                    torch.rand(SAMPLE_SHAPE),
+                    temp_path,
+                    input_names=["input"],
+                    output_names=["output"],
+                    dynamic_axes={
+                        "input": {2: "height", 3: "width"},
+                        "output": {2: "height", 3: "width"},
+                    },
+                )
+
+        write_atomic(path, export)
+
+    if not quantize:
+        return path
+
+    if not os.path.isfile(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        write_atomic(
+            quantized_path,
+            lambda temp_path: quantize_dynamic(
+                path, temp_path, weight_type=QuantType.QUInt8
+            ),
+        )
+
+    return quantized_path
+
+
+def onnx_engine(factor: int, quantize: bool, threads: int) -> Engine:
+    """Build an engine running the model with ONNX Runtime on the CPU
+
+    Args:
+        factor (int): upscale factor
+        quantize (bool): use the int8 quantized model
+        threads (int): intra-op threads
+
+    Returns:
+        Engine: engine mapping an input tensor to an output tensor
+    """
+
+    try:
+        import onnxruntime
+    except ImportError:
+        raise BackendUnavailable(
+            "The onnx backend requires the onnx extra: poetry install -E onnx"
+        )
+    import torch
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+
+    session = onnxruntime.InferenceSession(
+        export_onnx(factor, quantize),
+        sess_options=options,
+        providers=["CPUExecutionProvider"],
+    )
+
+    def run(inputs):
+        outputs = session.run(None, {"input": inputs.numpy()})
+        return torch.from_numpy(outputs[0])
+
+    return run
+
+
+def load_engine(
+    factor: int,
+    backend: str = BACKEND,
+    quantize: bool = QUANTIZE,
+    threads: int = THREADS,
+) -> Engine:
+    """Get the inference engine for a configuration, building it on first use
+
+    Args:
+        factor (int): upscale factor
+        backend (str): one of BACKENDS
+        quantize (bool): quantize the model to int8 (onnx backend only)
+        threads (int): intra-op threads
+
+    Returns:
+        Engine: engine mapping a (1, 3, H, W) float tensor to the upscaled
+            tensor
+    """
+
+    with ENGINE_LOCK:
+        return build_engine(factor, backend, quantize, threads)
+
+
+@lru_cache(maxsize=None)
+def build_engine(factor: int, backend: str, quantize: bool, threads: int) -> Engine:
+    """Build an inference engine, once per process and configuration
+
+    Args:
+        factor (int): upscale factor
+        backend (str): one of BACKENDS
+        quantize (bool): quantize the model to int8 (onnx backend only)
+        threads (int): intra-op threads
+
+    Returns:
+        Engine: engine mapping a (1, 3, H, W) float tensor to the upscaled
+            tensor
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+
+    if quantize and backend != "onnx":
+        raise ValueError("Quantization is only supported by the onnx backend")
+
+    set_threads(threads)
+
+    if backend == "eager":
+        return eager_engine(factor)
+    if backend == "torchscript":
+        return torchscript_engine(factor)
+
+    return onnx_engine(factor, quantize, threads)
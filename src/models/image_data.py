@@ -11,3 +11,4 @@ class ImageData(BaseModel):
     height: int
     format: str
     path: str = None
+    version: int = 0
@@ -4,10 +4,12 @@ from mongoengine import ValidationError
 from PIL import Image as Img
 import os
 import json
+from uuid import uuid4
 
-from database import Image
+from database import Image, lock_image, match_version, unlock_image
 from models import ModifyForm, ImageData
-from utils import is_image, apply_modifications
+from utils import is_image, stage_image
+from workers import apply_modifications
 from producer import rabbit_logging
 
 router = APIRouter(prefix="/images")
@@ -177,13 +179,23 @@ def delete_image(image_id: str) -> dict:
         if image is None:
             raise HTTPException(404, "Image does not exist")
 
-        # delete image in storage
-        if os.path.exists(image.path):
-            os.remove(image.path)
+        # make sure no worker is writing the image while it is deleted
+        token = lock_image(image_id)
+        if token is None:
+            raise HTTPException(409, "Image is being modified, try again later")
 
-        # delete image data form database
-        image.delete()
+        try:
+            # delete image in storage
+            if os.path.exists(image.path):
+                os.remove(image.path)
 
+            # delete image data form database
+            image.delete()
+        finally:
+            unlock_image(image_id, token)
+
+    except HTTPException:
+        raise
     except ValidationError:
         raise HTTPException(400, "Invalid Image ID")
     except Exception as e:
@@ -197,12 +209,14 @@ def delete_image(image_id: str) -> dict:
 
 
 @router.put("/replace/{image_id}")
-def replace_image(image_id: str, new_image: UploadFile) -> dict:
+def replace_image(image_id: str, new_image: UploadFile, version: int = None) -> dict:
     """Replace an image in the database, overwritting everything about it
 
     Args:
         image_id (str): id of image to be replaced
         new_image (UploadFile): new image
+        version (int, optional): expected image version, the request fails
+            if the image was changed since
 
     Returns:
         dict: JSON response
@@ -249,7 +263,13 @@ def replace_image(image_id: str, new_image: UploadFile) -> dict:
             "Image previously had invalid data saved, therefore the operation was halted for investigation",
         )
 
+    # make sure no worker is writing the image while it is replaced
+    token = lock_image(image_id)
+    if token is None:
+        raise HTTPException(409, "Image is being modified, try again later")
+
     # update image data
+    temp_path = None
     try:
 
         # validate new info
@@ -262,21 +282,40 @@ def replace_image(image_id: str, new_image: UploadFile) -> dict:
             path=f"storage/{image_id}.{extension}",
         )
 
-        # replace image info in database
-        dbimage.update(
+        # write the new image first, so a failed write leaves the image and
+        # its data untouched
+        temp_path = stage_image(loaded_image, data.path, loaded_image.format)
+        loaded_image.close()
+
+        # replace image info in database, bumping its version and dropping
+        # modifications queued for the old image
+        query = Image.objects(id=image_id, locked_by=token)
+        if version is not None:
+            query = query.filter(match_version(version))
+
+        dbimage = query.modify(
             set__size=data.size,
             set__format=data.format,
             set__width=data.width,
             set__height=data.height,
             set__path=data.path,
+            set__pending=[],
+            inc__version=1,
         )
+        if dbimage is None:
+            raise HTTPException(409, "Image was modified by another request")
 
-        dbimage.save()
+        data.version = dbimage.version + 1
 
-        # replace image in storage
-        loaded_image.save(data.path)
-        loaded_image.close()
+        # move the new image in place, removing the old one if the format
+        # changed
+        os.replace(temp_path, data.path)
+        temp_path = None
+        if dbimage.path != data.path and os.path.exists(dbimage.path):
+            os.remove(dbimage.path)
 
+    except HTTPException:
+        raise
     except ValueError:
         rabbit_logging("logging.database", "ERROR: Image has invalid metadata")
         raise HTTPException(400, "Image has invalid metadata")
@@ -287,80 +326,71 @@ def replace_image(image_id: str, new_image: UploadFile) -> dict:
         )
         raise HTTPException(500, "Could not update image data, reason: " + str(e))
 
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+        unlock_image(image_id, token)
+
     return data.model_dump()
 
 
-@router.put("/{image_id}")
-def modify_image(image_id: str, modifications: ModifyForm = Body()) -> dict:
-    """Modify an image on the server
+@router.put("/{image_id}", status_code=202)
+def modify_image(
+    image_id: str, modifications: ModifyForm = Body(), version: int = None
+) -> dict:
+    """Queue modifications for an image on the server. Workers apply them in
+    order and update the image data in the database once they are done, so
+    the response only confirms the modifications were queued
 
     Args:
         image_id (str): id of the image
         modifications (dict): modifications represented as JSON
+        version (int, optional): expected image version, the request fails
+            if the image was changed since
 
     Returns:
         dict: JSON response
     """
 
-    # convert to dict for iteration
+    # convert to dict for storage in the image's queue, with an id workers
+    # use to remove it from the queue once applied
     modifications = modifications.model_dump()
+    modifications["job"] = uuid4().hex
 
-    # open image and process modifications using drastiq workers
+    # queue modifications and bump the version in a single atomic update
     try:
         dbimage = Image.objects(id=image_id).first()
-        image_path = dbimage.path
-        if not os.path.isfile(image_path):
-            raise Exception
+        if dbimage is None or not os.path.isfile(dbimage.path):
+            raise HTTPException(404, "Could not find image")
+
+        query = Image.objects(id=image_id)
+        if version is not None:
+            query = query.filter(match_version(version))
+
+        dbimage = query.modify(push__pending=modifications, inc__version=1, new=True)
+        if dbimage is None:
+            # the image may have been deleted since it was found
+            if not Image.objects(id=image_id).count():
+                raise HTTPException(404, "Could not find image")
+            raise HTTPException(409, "Image was modified by another request")
+
+    except HTTPException:
+        raise
     except ValidationError:
         raise HTTPException(400, "Invalid image id")
     except Exception as e:
         rabbit_logging(
             "logging.database",
-            "ERROR: Could not find image on server, reason: " + str(e),
+            "ERROR: Could not queue image modifications, reason: " + str(e),
         )
-        raise HTTPException(404, "Could not find image")
+        raise HTTPException(500, "Could not queue image modifications")
 
     # ! workers will do the changes, then write the image to disk, and return nothing
-    message = apply_modifications.send(image_path, modifications)
+    message = apply_modifications.send(image_id)
     del message  # just so flake8 stops screaming at me
-    # try:
-    #     result = message.get_result(block=True)
-    # except Exception as e:
-    #     raise HTTPException(500, str(e))
-    # ! ------------------
 
-    # reopen the image and update data in the database
-    try:
-        modified_image = Img.open(image_path)
-
-        # validate new image data
-        data = ImageData(
-            id=image_id,
-            size=os.path.getsize(image_path) * 0.000001,
-            format=modified_image.format.lower(),
-            width=modified_image.width,
-            height=modified_image.height,
-            path=f"storage/{image_id}.{modified_image.format.lower()}",
-        )
-        modified_image.close()
-
-        # update database details
-        dbimage.update(
-            set__size=data.size,
-            set__format=data.format,
-            set__width=data.width,
-            set__height=data.height,
-            set__path=data.path,
-        )
-        dbimage.save()
-        # rabbit_logging("logging.database", "INFO: Image data updated successfully")
-
-    except Exception as e:
-        rabbit_logging(
-            "logging.database",
-            "ERROR: Image data could not be updated, reason: " + str(e),
-        )
-        raise HTTPException(500, "Image data could not be updated")
-
-    # return {"detail": "Image modified successfully!"}
-    return data.model_dump()
+    return {
+        "detail": "Image modifications queued",
+        "id": image_id,
+        "version": dbimage.version,
+    }
@@ -0,0 +1,28 @@
+"""Tests run without MongoDB or RabbitMQ: mongomock stands in for the
+database, dramatiq's stub broker for the workers' queue, and the producer's
+RabbitMQ connection, opened on import, is mocked"""
+
+from unittest import mock
+import dramatiq
+from dramatiq.brokers.stub import StubBroker
+import mongoengine
+import mongomock
+import pytest
+
+dramatiq.set_broker(StubBroker())
+mock.patch("pika.BlockingConnection").start()
+
+
+@pytest.fixture
+def db():
+    """Connect the documents to an empty in-memory database"""
+
+    from database import Image
+
+    mongoengine.disconnect()
+    mongoengine.connect("imageCRUD", mongo_client_class=mongomock.MongoClient)
+
+    yield
+
+    Image.drop_collection()
+    mongoengine.disconnect()
@@ -0,0 +1,29 @@
+from database import Image, lock_image, match_version, unlock_image
+
+
+def test_match_version(db):
+    image = Image(path="storage/image.png", version=3).save()
+
+    assert Image.objects(match_version(3)).first() == image
+    assert Image.objects(match_version(0)).first() is None
+
+
+def test_missing_version_matches_zero(db):
+    # images saved before versioning have no version field
+    image = Image(path="storage/image.png").save()
+    Image.objects(id=image.id).update(unset__version=True)
+
+    assert Image.objects(match_version(0)).first() == image
+    assert Image.objects(match_version(1)).first() is None
+
+
+def test_lock_is_exclusive(db):
+    image = Image(path="storage/image.png").save()
+
+    token = lock_image(image.id)
+    assert token is not None
+    assert lock_image(image.id) is None
+
+    assert not unlock_image(image.id, "another token")
+    assert unlock_image(image.id, token)
+    assert lock_image(image.id) is not None
@@ -0,0 +1,33 @@
+import os
+import stat
+import pytest
+from PIL import Image
+
+from utils import save_image
+
+
+def test_save_image(tmp_path):
+    path = tmp_path / "image.png"
+    save_image(Image.new("RGB", (4, 3)), str(path), "PNG")
+
+    assert os.listdir(tmp_path) == ["image.png"]
+    assert Image.open(path).size == (4, 3)
+
+
+def test_save_image_is_world_readable(tmp_path):
+    path = tmp_path / "image.png"
+    save_image(Image.new("RGB", (4, 3)), str(path), "PNG")
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+
+def test_save_image_failure_leaves_no_temp_file(tmp_path):
+    path = tmp_path / "image.png"
+    save_image(Image.new("RGB", (4, 3)), str(path), "PNG")
+
+    with pytest.raises(KeyError):
+        save_image(Image.new("RGB", (8, 6)), str(path), "NOT A FORMAT")
+
+    # the previous image is left untouched
+    assert os.listdir(tmp_path) == ["image.png"]
+    assert Image.open(path).size == (4, 3)
@@ -0,0 +1,68 @@
+from unittest import mock
+import pytest
+from PIL import Image as Img
+
+from database import Image, lock_image
+from workers import ImageLocked, apply_modifications, modify_all
+
+
+def test_modify_all_applies_queue_in_order():
+    image = Img.new("RGB", (20, 10))
+    queue = [{"width": 30}, {"width": 15, "height": 5}, {"grayscale": True}]
+
+    image = modify_all(image, queue)
+
+    assert image.size == (15, 5)
+    assert image.mode == "L"
+
+
+@pytest.fixture
+def stored_image(db, tmp_path):
+    path = tmp_path / "image.png"
+    Img.new("RGB", (20, 10)).save(path)
+
+    return Image(path=str(path), format="png", width=20, height=10).save()
+
+
+def test_apply_modifications_in_one_pass(stored_image):
+    Image.objects(id=stored_image.id).update(
+        push_all__pending=[
+            {"job": "1", "width": 40},
+            {"job": "2", "height": 30},
+        ]
+    )
+
+    with mock.patch("workers.Img.open", wraps=Img.open) as open_image:
+        apply_modifications(str(stored_image.id))
+
+    open_image.assert_called_once()
+    stored_image.reload()
+    assert Img.open(stored_image.path).size == (40, 30)
+    assert (stored_image.width, stored_image.height) == (40, 30)
+    assert stored_image.pending == []
+    assert stored_image.locked_by is None
+
+
+def test_apply_modifications_keeps_queue_on_failure(stored_image):
+    Image.objects(id=stored_image.id).update(push__pending={"job": "1", "width": 40})
+
+    with mock.patch("workers.save_image", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            apply_modifications(str(stored_image.id))
+
+    # the modifications are kept for the retry, and the lock is released
+    stored_image.reload()
+    assert stored_image.pending == [{"job": "1", "width": 40}]
+    assert stored_image.locked_by is None
+    assert Img.open(stored_image.path).size == (20, 10)
+
+
+def test_apply_modifications_retries_locked_image(stored_image):
+    Image.objects(id=stored_image.id).update(push__pending={"job": "1", "width": 40})
+    lock_image(stored_image.id)
+
+    with pytest.raises(ImageLocked):
+        apply_modifications(str(stored_image.id))
+
+    stored_image.reload()
+    assert len(stored_image.pending) == 1